@@ -5,34 +5,64 @@ import asyncio
 from dataclasses import dataclass
 import json
 import logging
+import os
+from pathlib import Path
+import sys
+import time
 
-from aiohttp import ClientError
-import async_timeout
+from aiohttp import ClientError, ClientSession, TCPConnector
+
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+if sys.version_info >= (3, 11):
+    from asyncio import timeout as _timeout
+else:
+    from async_timeout import timeout as _timeout
 
 _LOGGER = logging.getLogger(__name__)
 
 API_URL = "https://ext-api.airthings.com/v1/"
 TIMEOUT = 10
+TOKEN_EXPIRY_MARGIN = 60
+CATALOG_CACHE_MAX_AGE = 24 * 60 * 60
+MAX_CONCURRENT_REQUESTS = 5
+RETRY_AFTER_DEFAULT = 1
 
 
 @dataclass
 class AirthingsLocation:
     """Airthings location."""
+    __slots__ = ("location_id", "name", "latest_samples_url")
+
     location_id: str
     name: str
 
+    def __post_init__(self):
+        """Build the latest samples url once."""
+        self.latest_samples_url = f"{API_URL}/locations/{self.location_id}/latest-samples"
+
     @classmethod
     def init_from_response(cls, response):
         """Class method."""
-        return cls(
-            response.get("id"),
-            response.get("name"),
-        )
+        return cls(response["id"], response["name"])
 
 
 @dataclass
 class AirthingsDevice:
     """Airthings device."""
+    __slots__ = (
+        "device_id",
+        "name",
+        "sensors",
+        "is_active",
+        "location_name",
+        "device_type",
+        "product_name",
+    )
+
     device_id: str
     name: str
     sensors: dict[str, float | None]
@@ -44,14 +74,15 @@ class AirthingsDevice:
     @classmethod
     def init_from_response(cls, response, location_name, device):
         """Class method."""
+        segment = response["segment"]
         return cls(
-            response.get("id"),
-            response.get("segment").get("name"),
-            response.get("data"),
-            response.get("segment").get("isActive"),
+            response["id"],
+            segment["name"],
+            response["data"],
+            segment["isActive"],
             location_name,
-            device.get('deviceType'),
-            device.get('productName'),
+            device["deviceType"] if device else None,
+            device["productName"] if device else None,
         )
 
     @property
@@ -72,125 +103,330 @@ class AirthingsAuthError(AirthingsError):
     """AirthingsAuthError Airthings occurred."""
 
 
+class AirthingsNotFoundError(AirthingsError):
+    """AirthingsNotFoundError Airthings occurred."""
+
+
 class Airthings:
     """Airthings data handler."""
 
-    def __init__(self, client_id, secret, websession):
-        """Init Airthings data handler."""
+    def __init__(self, client_id, secret, websession=None, cache_path=None):
+        """Init Airthings data handler.
+
+        A passed websession should be reused for the lifetime of the process.
+        Without one, a pooled session is created on first use and must be
+        closed with close() or by using the handler as an async context manager.
+
+        If cache_path is set, the locations and devices catalog is stored there
+        and reused across restarts for up to CATALOG_CACHE_MAX_AGE seconds.
+        """
         self._client_id = client_id
         self._secret = secret
         self._websession = websession
+        self._cache_path = Path(cache_path) if cache_path is not None else None
+        self._close_websession = False
         self._access_token = None
+        self._token_expires_at = 0.0
+        self._token_refresh_task = None
+        self._semaphore = None
         self._locations = []
+        self._active_locations = []
         self._devices = {}
+        self._catalog_from_cache = False
+
+    async def __aenter__(self):
+        """Enter the async context manager."""
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Exit the async context manager."""
+        await self.close()
+
+    async def close(self):
+        """Close the websession if it was created by this handler."""
+        if self._close_websession and self._websession is not None:
+            await self._websession.close()
+            self._websession = None
+            self._close_websession = False
+
+    def _get_websession(self):
+        """Return the websession, creating a pooled one if none was given."""
+        if self._websession is None:
+            self._websession = ClientSession(
+                connector=TCPConnector(
+                    limit=10,
+                    limit_per_host=10,
+                    keepalive_timeout=75,
+                    ttl_dns_cache=300,
+                )
+            )
+            self._close_websession = True
+        return self._websession
+
+    def _get_semaphore(self):
+        """Return the request semaphore, created inside the running loop."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        return self._semaphore
 
     async def update_devices(self):
         """Update data."""
-        if not self._locations:
-            response = await self._request(API_URL + "locations")
-            json_data = await response.json()
-            self._locations = []
-            for location in json_data.get("locations"):
-                self._locations.append(AirthingsLocation.init_from_response(location))
-        if not self._devices:
-            response = await self._request(API_URL + "devices")
-            json_data = await response.json()
-            self._devices = {}
-            for device in json_data.get("devices"):
-                self._devices[device['id']] = device
-        res = {}
-        for location in self._locations:
-            if not location.location_id:
-                continue
-            response = await self._request(
-                API_URL + f"/locations/{location.location_id}/latest-samples"
+        if not self._locations or not self._devices:
+            await self._load_catalog()
+        locations = self._active_locations
+        responses = await asyncio.gather(
+            *(self._request(location.latest_samples_url) for location in locations),
+            return_exceptions=True,
+        )
+        fetched = []
+        errors = []
+        catalog_outdated = False
+        for location, response in zip(locations, responses):
+            if isinstance(response, AirthingsNotFoundError):
+                _LOGGER.warning("Location '%s' not found, reloading devices", location.name)
+                catalog_outdated = True
+            elif isinstance(response, AirthingsError):
+                errors.append(response)
+            elif isinstance(response, BaseException):
+                raise response
+            elif response is not None:
+                fetched.append((location, response))
+        try:
+            if errors and not fetched:
+                raise errors[0]
+
+            json_datas = await asyncio.gather(
+                *(response.json(loads=_loads) for _, response in fetched)
             )
-            if response is None:
-                continue
-            json_data = await response.json()
-            if json_data is None:
-                continue
-            if devices := json_data.get("devices"):
-                for device in devices:
-                    id = device.get('id')
-                    res[id] = AirthingsDevice.init_from_response(
-                        device,
-                        location.name,
-                        self._devices.get(id)
-                    )
-            else:
-                _LOGGER.debug("No devices in location '%s'", location.name)
+            res = {}
+            for (location, _), json_data in zip(fetched, json_datas):
+                if json_data is None:
+                    continue
+                if devices := json_data.get("devices"):
+                    for device in devices:
+                        id = device.get('id')
+                        catalog_device = self._devices.get(id)
+                        if catalog_device is None and self._catalog_from_cache:
+                            _LOGGER.debug("Device '%s' not in cached catalog, reloading devices", id)
+                            catalog_outdated = True
+                        res[id] = AirthingsDevice.init_from_response(
+                            device,
+                            location.name,
+                            catalog_device
+                        )
+                else:
+                    _LOGGER.debug("No devices in location '%s'", location.name)
+        finally:
+            if catalog_outdated:
+                await self._invalidate_catalog()
         return res
 
-    async def _request(self, url, json_data=None, retry=3):
-        _LOGGER.debug("Request %s %s, %s", url, retry, json_data)
-        if self._access_token is None:
-            self._access_token = await get_token(
-                self._websession, self._client_id, self._secret
+    async def _load_catalog(self):
+        """Load locations and devices, from the cache file when it is fresh."""
+        loop = asyncio.get_running_loop()
+        catalog = None
+        if self._cache_path is not None:
+            catalog = await loop.run_in_executor(None, self._read_catalog_cache)
+        self._catalog_from_cache = catalog is not None
+        if catalog is None:
+            responses = await asyncio.gather(
+                self._request(API_URL + "locations"),
+                self._request(API_URL + "devices"),
+            )
+            locations_data, devices_data = await asyncio.gather(
+                *(response.json(loads=_loads) for response in responses)
+            )
+            catalog = {
+                "client_id": self._client_id,
+                "locations": locations_data.get("locations"),
+                "devices": devices_data.get("devices"),
+            }
+            if not _is_valid_catalog(catalog):
+                _LOGGER.error("Unexpected locations or devices response from Airthings")
+                raise AirthingsError("Unexpected locations or devices response from Airthings")
+            if self._cache_path is not None:
+                await loop.run_in_executor(None, self._write_catalog_cache, catalog)
+        self._locations = []
+        for location in catalog["locations"]:
+            self._locations.append(AirthingsLocation.init_from_response(location))
+        self._active_locations = [
+            location for location in self._locations if location.location_id
+        ]
+        self._devices = {}
+        for device in catalog["devices"]:
+            self._devices[device['id']] = device
+
+    async def _invalidate_catalog(self):
+        """Drop the cached locations and devices."""
+        self._locations = []
+        self._active_locations = []
+        self._devices = {}
+        if self._cache_path is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._remove_catalog_cache
             )
-            if self._access_token is None:
+
+    def _read_catalog_cache(self):
+        """Read the catalog cache file, None if missing, stale or invalid."""
+        try:
+            if time.time() - self._cache_path.stat().st_mtime > CATALOG_CACHE_MAX_AGE:
                 return None
+            catalog = _loads(self._cache_path.read_bytes())
+        except (OSError, ValueError):
+            return None
+        if (
+            not isinstance(catalog, dict)
+            or catalog.get("client_id") != self._client_id
+            or not _is_valid_catalog(catalog)
+        ):
+            return None
+        return catalog
 
-        headers = {"Authorization": self._access_token}
+    def _write_catalog_cache(self, catalog):
+        """Atomically write the catalog cache file."""
+        tmp_path = self._cache_path.with_name(self._cache_path.name + ".tmp")
         try:
-            async with async_timeout.timeout(TIMEOUT):
-                if json_data:
-                    response = await self._websession.post(
-                        url, json=json_data, headers=headers
-                    )
-                else:
-                    response = await self._websession.get(url, headers=headers)
-            if response.status != 200:
-                if retry > 0 and response.status != 429:
-                    self._access_token = None
-                    return await self._request(url, json_data, retry=retry - 1)
-                _LOGGER.error(
-                    "Error connecting to Airthings, response: %s %s",
-                    response.status,
-                    response.reason,
-                )
-                raise AirthingsError(
-                    f"Error connecting to Airthings, response: {response.reason}"
+            tmp_path.write_text(json.dumps(catalog))
+            os.replace(tmp_path, self._cache_path)
+        except OSError as err:
+            _LOGGER.warning("Failed to write Airthings cache %s: %s", self._cache_path, err)
+
+    def _remove_catalog_cache(self):
+        """Remove the catalog cache file."""
+        try:
+            self._cache_path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            _LOGGER.warning("Failed to remove Airthings cache %s: %s", self._cache_path, err)
+
+    async def _ensure_token(self):
+        """Return a valid access token, refreshing it when about to expire."""
+        if self._access_token is not None and time.monotonic() < self._token_expires_at:
+            return self._access_token
+        if self._token_refresh_task is None or self._token_refresh_task.done():
+            self._token_refresh_task = asyncio.ensure_future(self._refresh_token())
+        return await asyncio.shield(self._token_refresh_task)
+
+    async def _refresh_token(self):
+        """Fetch a new access token, shared by all concurrent callers."""
+        self._access_token, expires_in = await _fetch_token(
+            self._get_websession(), self._client_id, self._secret
+        )
+        if expires_in is None:
+            # Without a lifetime, keep the token until the API rejects it with 401
+            self._token_expires_at = float("inf")
+        else:
+            margin = min(TOKEN_EXPIRY_MARGIN, expires_in / 2)
+            self._token_expires_at = time.monotonic() + expires_in - margin
+        return self._access_token
+
+    async def _request(self, url, retry=3):
+        return await self._send("GET", url, retry=retry)
+
+    async def _send(self, method, url, retry=3, **kwargs):
+        request = self._get_websession().request
+        semaphore = self._get_semaphore()
+        ensure_token = self._ensure_token
+        debug_enabled = _LOGGER.isEnabledFor(logging.DEBUG)
+        for retries_left in range(max(retry, 0), -1, -1):
+            if debug_enabled:
+                _LOGGER.debug("Request %s %s %s, %s", method, url, retries_left, kwargs)
+            async with semaphore:
+                # Read the token after waiting for a slot, so it is the current one
+                access_token = await ensure_token()
+                if access_token is None:
+                    return None
+                try:
+                    async with _timeout(TIMEOUT):
+                        response = await request(
+                            method, url, headers={"Authorization": access_token}, **kwargs
+                        )
+                except ClientError as err:
+                    _LOGGER.error("Error connecting to Airthings: %s ", err, exc_info=True)
+                    raise AirthingsError from err
+                except asyncio.TimeoutError as err:
+                    if retries_left > 0:
+                        continue
+                    _LOGGER.error("Timed out when connecting to Airthings")
+                    raise AirthingsError from err
+            if response.status == 200:
+                return response
+            # Free the pooled connection of responses that are not returned
+            response.release()
+            if response.status == 404:
+                _LOGGER.error("Not found at Airthings: %s", url)
+                raise AirthingsNotFoundError(
+                    f"Not found at Airthings, response: {response.reason}"
                 )
-        except ClientError as err:
-            self._access_token = None
-            _LOGGER.error("Error connecting to Airthings: %s ", err, exc_info=True)
-            raise AirthingsError from err
-        except asyncio.TimeoutError as err:
-            self._access_token = None
-            if retry > 0:
-                return await self._request(url, json_data, retry=retry - 1)
-            _LOGGER.error("Timed out when connecting to Airthings")
-            raise AirthingsError from err
-        return response
+            if retries_left > 0:
+                if response.status == 401:
+                    if self._access_token == access_token:
+                        self._access_token = None
+                elif response.status == 429:
+                    await asyncio.sleep(_retry_after(response))
+                continue
+            _LOGGER.error(
+                "Error connecting to Airthings, response: %s %s",
+                response.status,
+                response.reason,
+            )
+            raise AirthingsError(
+                f"Error connecting to Airthings, response: {response.reason}"
+            )
+
+
+def _is_valid_catalog(catalog):
+    """Check that the catalog holds lists of locations and devices."""
+    return isinstance(catalog.get("locations"), list) and isinstance(
+        catalog.get("devices"), list
+    )
+
+
+def _retry_after(response):
+    """Seconds to wait before retrying a rate limited request."""
+    try:
+        delay = float(response.headers.get("Retry-After", RETRY_AFTER_DEFAULT))
+    except ValueError:
+        delay = RETRY_AFTER_DEFAULT
+    return min(max(delay, 0), TIMEOUT)
 
 
 async def get_token(websession, client_id, secret, retry=3, timeout=10):
     """Get token for Airthings."""
-    try:
-        async with async_timeout.timeout(timeout):
-            response = await websession.post(
-                "https://accounts-api.airthings.com/v1/token",
-                headers={
-                    "Content-type": "application/x-www-form-urlencoded",
-                    "Accept": "application/json",
-                },
-                data={
-                    "grant_type": "client_credentials",
-                    "client_id": client_id,
-                    "client_secret": secret,
-                },
-            )
-    except ClientError as err:
-        if retry > 0:
-            return await get_token(websession, client_id, secret, retry - 1, timeout)
-        _LOGGER.error("Error getting token Airthings: %s ", err, exc_info=True)
-        raise AirthingsConnectionError from err
-    except asyncio.TimeoutError as err:
-        if retry > 0:
-            return await get_token(websession, client_id, secret, retry - 1, timeout)
-        _LOGGER.error("Timed out when connecting to Airthings for token")
-        raise AirthingsConnectionError from err
+    access_token, _ = await _fetch_token(websession, client_id, secret, retry, timeout)
+    return access_token
+
+
+async def _fetch_token(websession, client_id, secret, retry=3, timeout=10):
+    """Get token and its lifetime in seconds for Airthings."""
+    post = websession.post
+    for retries_left in range(max(retry, 0), -1, -1):
+        try:
+            async with _timeout(timeout):
+                response = await post(
+                    "https://accounts-api.airthings.com/v1/token",
+                    headers={
+                        "Content-type": "application/x-www-form-urlencoded",
+                        "Accept": "application/json",
+                    },
+                    data={
+                        "grant_type": "client_credentials",
+                        "client_id": client_id,
+                        "client_secret": secret,
+                    },
+                )
+        except ClientError as err:
+            if retries_left > 0:
+                continue
+            _LOGGER.error("Error getting token Airthings: %s ", err, exc_info=True)
+            raise AirthingsConnectionError from err
+        except asyncio.TimeoutError as err:
+            if retries_left > 0:
+                continue
+            _LOGGER.error("Timed out when connecting to Airthings for token")
+            raise AirthingsConnectionError from err
+        break
     if response.status != 200:
         _LOGGER.error(
             "Airthings: Failed to login to retrieve token: %s %s",
@@ -198,5 +434,5 @@ async def get_token(websession, client_id, secret, retry=3, timeout=10):
             response.reason,
         )
         raise AirthingsAuthError(f"Failed to login to retrieve token {response.reason}")
-    token_data = json.loads(await response.text())
-    return token_data.get("access_token")
+    token_data = await response.json(loads=_loads, content_type=None)
+    return token_data.get("access_token"), token_data.get("expires_in")